@@ -1,19 +1,118 @@
 # Author: Sebastian Orozco
 
-from openai import OpenAI
-from text_extractor import PDFTextExtractor
+import openai
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from text_extractor import MAX_CONCURRENT_DOWNLOADS, PDFTextExtractor, create_pdf_session, extract_text_in_pool, fetch_pdf, run_sync
 import pandas as pd
+import numpy as np
+import faiss
+import tiktoken
+import pickle
+import asyncio
+from collections import Counter
 import csv
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from typing import Literal
+from pydantic import BaseModel, ConfigDict, Field
 from secrets import OPEN_API_KEY
 
-total_tokens = 0
+# Max number of grading requests in flight at once.
+MAX_CONCURRENT_REQUESTS = 50
+# Cap on requests started per minute, to stay under the account's RPM limit.
+MAX_REQUESTS_PER_MIN = 500
 
-client = OpenAI(
-  api_key=OPEN_API_KEY
+# Transient OpenAI errors retried with exponential backoff + jitter, up to MAX_RETRY_ATTEMPTS tries.
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+MAX_RETRY_ATTEMPTS = 6
+
+# When the rate limit headers report nothing left, no new request starts before this time.monotonic() value
+rate_limit_resume_at = 0.0
+
+# Retries are handled by _call_openai, so the client's own retry loop is disabled
+client = AsyncOpenAI(
+  api_key=OPEN_API_KEY,
+  max_retries=0
+)
+
+class RequestRateLimiter:
+    # Spaces out request starts so no more than max_requests_per_min are sent per minute
+    def __init__(self, max_requests_per_min):
+        self.interval = 60.0 / max_requests_per_min
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        # Hold off while the account's request or token budget is exhausted
+        pause = rate_limit_resume_at - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+def _parse_duration(value):
+    # Parses rate limit reset values such as "20ms", "1s" or "6m0s" into seconds
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * units[unit] for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value or ""))
+
+def _retry_after_seconds(exception):
+    # Returns the server-requested wait from a failed response's headers, if any
+    response = getattr(exception, "response", None)
+    if response is None:
+        return None
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+_backoff = wait_random_exponential(min=1, max=60)
+
+def _wait_retry_after(retry_state):
+    # Exponential backoff with jitter, but never shorter than the server's Retry-After
+    backoff = _backoff(retry_state)
+    retry_after = _retry_after_seconds(retry_state.outcome.exception())
+    return max(backoff, retry_after) if retry_after else backoff
+
+def _note_rate_limit_headers(headers):
+    # Pauses new requests until the reported reset time when requests or tokens are used up
+    global rate_limit_resume_at
+    for kind in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            reset = _parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            rate_limit_resume_at = max(rate_limit_resume_at, time.monotonic() + reset)
+
+@retry(
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(MAX_RETRY_ATTEMPTS),
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    reraise=True
 )
+async def _call_openai(endpoint, method="create", /, **kwargs):
+    # Calls endpoint.<method>(**kwargs) (e.g. client.chat.completions.create), retrying transient failures.
+    # endpoint and method are positional-only so kwargs can carry API fields of the same name.
+    raw_response = await getattr(endpoint.with_raw_response, method)(**kwargs)
+    _note_rate_limit_headers(raw_response.headers)
+    return raw_response.parse()
 
-def grade_comment(comment_id, comment_text):
-    prompt = f"""
+# Static rubric sent as the system message. It must stay byte-identical across calls (no
+# interpolated values) so the provider can reuse the cached prompt prefix. If this is ported
+# to Anthropic, mark this block with cache_control={"type": "ephemeral"}.
+RUBRIC_SYSTEM = """
     You are a grading assistant for Public Participation in Environmental Regulation (PPER).
     Use the criteria below to grade the given comment.
 
@@ -29,77 +128,638 @@ def grade_comment(comment_id, comment_text):
     6. **Pro-Environmental Regulation (1-5):** 1 = Strongly anti-environment, 5 = Strongly pro-environment.
     7. **Bias:** Primarily economic concerns, Primarily environmental concerns, Balanced perspective, Other.
     8. **Other Feedback:** Any additional insights.
+    """
+
+class GradedComment(BaseModel):
+    # Structured grading returned by the model; field order follows the rubric criteria
+    model_config = ConfigDict(extra="forbid")  # strict JSON schemas require additionalProperties: false
 
-    Please provide the grading in the following format:
+    authorship: Literal["Citizen", "NGO/Activist Group", "Business/Industry Representative", "Government/Agency Official", "Other"]
+    professionalism: int = Field(description="1 = Informal, disrespectful, 5 = Formal, respectful")
+    use_of_evidence: Literal["Yes", "No"]
+    logical_argumentation: int = Field(description="1 = No logical sense, 5 = Very compelling, clear logic")
+    emotional_tone: Literal["Positive", "Neutral", "Negative"]
+    pro_environmental_regulation: int = Field(description="1 = Strongly anti-environment, 5 = Strongly pro-environment")
+    bias: Literal["Primarily economic concerns", "Primarily environmental concerns", "Balanced perspective", "Other"]
+    other_feedback: str
 
-    Authorship: <Answer>  
-    Professionalism: <Answer>  
-    Use of Evidence/Reasoning: <Answer>  
-    Logical Argumentation: <Answer>  
-    Emotional Tone: <Answer>  
-    Pro-Environmental Regulation: <Answer>  
-    Bias: <Answer>  
-    Other Feedback: <Answer>
+# Raw response_format for requests that can't pass the Pydantic model directly (e.g. Batch API files)
+GRADED_COMMENT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "GradedComment", "strict": True, "schema": GradedComment.model_json_schema()}
+}
+
+class NumberedGradedComment(GradedComment):
+    # The comment's number within a batched request, used to match gradings back to comments
+    id: int
+
+class GradedCommentBatch(BaseModel):
+    gradings: list[NumberedGradedComment]
+
+GRADING_MODEL = "gpt-4o-mini"
+
+# Persistent cache of graded responses, keyed by a hash of model + prompt + comment text.
+GRADE_CACHE_DB = "data/grade_cache.sqlite"
+# Seconds before a cached grading expires. None keeps entries forever.
+GRADE_CACHE_TTL = None
+
+# Record of PDF URLs already graded and of gradings by PDF content hash, so re-runs and
+# PDFs attached to several comments are not downloaded or graded again.
+PROCESSED_URLS_DB = "data/processed_urls.sqlite"
+
+# Near-duplicate (e.g. form letter) comments reuse a prior grading when the cosine
+# similarity of their embeddings is at least SEMANTIC_CACHE_THRESHOLD.
+SEMANTIC_CACHE_INDEX = "data/grade_semantic_cache.index"
+SEMANTIC_CACHE_RESPONSES = "data/grade_semantic_cache.pkl"
+SEMANTIC_CACHE_THRESHOLD = 0.93
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+# Comment text is truncated to the embedding model's input limit, measured in tokens.
+EMBEDDING_MAX_TOKENS = 8191
+
+# Max number of comments packed into a single grading request.
+GRADING_BATCH_SIZE = 8
+# Rough per-request budget for comment text (~6k tokens at ~4 characters per token).
+GRADING_BATCH_MAX_CHARS = 24000
+
+# Batch API (offline) grading: request file location, turnaround window and status poll interval.
+BATCH_INPUT_JSONL = "data/grading_batch_input.jsonl"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_SECONDS = 60
+
+# Extra instructions sent after the rubric when several comments share one request.
+BATCH_INSTRUCTIONS = """
+    You will receive several numbered comments. Grade each one independently and return
+    one grading per comment, with "id" set to the comment's number.
     """
 
-    # Send the prompt to OpenAI's API
-    completion = client.chat.completions.create(
-    model="gpt-4o-mini",
+class GradeCache:
+    # SQLite-backed store of graded responses. Entries older than cache_ttl seconds are ignored.
+    def __init__(self, db_path=GRADE_CACHE_DB, cache_ttl=GRADE_CACHE_TTL):
+        self.db_path = db_path
+        self.cache_ttl = cache_ttl
+        self.conn = None
+
+    def _get_connection(self):
+        if self.conn is None:
+            if os.path.dirname(self.db_path):
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            # Runs may come from run_sync's helper thread, so the connection isn't tied to one thread
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT, tokens INT, ts REAL)")
+            self.conn.commit()
+        return self.conn
+
+    def key(self, comment_text):
+        return hashlib.sha256((GRADING_MODEL + RUBRIC_SYSTEM + comment_text).encode()).hexdigest()
+
+    def get(self, comment_text):
+        row = self._get_connection().execute(
+            "SELECT response, ts FROM cache WHERE key=?", (self.key(comment_text),)
+        ).fetchone()
+        if row and (self.cache_ttl is None or time.time() - row[1] < self.cache_ttl):
+            return row[0]
+        return None
+
+    def put(self, comment_text, response, tokens, ts=None):
+        # ts defaults to now; pass the original time when copying an existing grading so it expires on schedule
+        conn = self._get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, response, tokens, ts) VALUES (?, ?, ?, ?)",
+            (self.key(comment_text), response, tokens, time.time() if ts is None else ts)
+        )
+        conn.commit()
+
+class ProcessedPdfStore:
+    # SQLite record of processed PDF URLs (url -> content hash, commentId) and gradings by content hash
+    def __init__(self, db_path=PROCESSED_URLS_DB):
+        self.db_path = db_path
+        self.conn = None
+
+    def _get_connection(self):
+        if self.conn is None:
+            if os.path.dirname(self.db_path):
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            # Runs may come from run_sync's helper thread, so the connection isn't tied to one thread
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS processed_urls (url TEXT PRIMARY KEY, content_sha256 TEXT, comment_id TEXT, ts REAL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS graded_content (content_sha256 TEXT PRIMARY KEY, graded_feedback TEXT, ts REAL)")
+            self.conn.commit()
+        return self.conn
+
+    def is_processed(self, url):
+        return self._get_connection().execute("SELECT 1 FROM processed_urls WHERE url=?", (url,)).fetchone() is not None
+
+    def get_grading(self, content_sha256):
+        row = self._get_connection().execute(
+            "SELECT graded_feedback FROM graded_content WHERE content_sha256=?", (content_sha256,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_url_grading(self, url):
+        # Grading stored for the content last downloaded from url, if any
+        row = self._get_connection().execute(
+            "SELECT g.graded_feedback FROM processed_urls p JOIN graded_content g ON g.content_sha256 = p.content_sha256 WHERE p.url=?",
+            (url,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def mark_processed(self, url, content_sha256, comment_id, graded_feedback=None):
+        conn = self._get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO processed_urls (url, content_sha256, comment_id, ts) VALUES (?, ?, ?, ?)",
+            (url, content_sha256, str(comment_id), time.time())
+        )
+        if graded_feedback is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO graded_content (content_sha256, graded_feedback, ts) VALUES (?, ?, ?)",
+                (content_sha256, graded_feedback, time.time())
+            )
+        conn.commit()
+
+@functools.lru_cache(maxsize=None)
+def _grading_version():
+    # Identifies the model, rubric and output schema a grading was made with
+    schema = json.dumps(GradedComment.model_json_schema(), sort_keys=True)
+    return hashlib.sha256((GRADING_MODEL + RUBRIC_SYSTEM + schema).encode()).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def _embedding_encoding():
+    return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+class SemanticCache:
+    # FAISS inner-product index over normalized comment embeddings, with a parallel list of
+    # (grading, ts, grading version) entries. Like GradeCache, entries older than cache_ttl seconds
+    # are ignored, as are entries made with a different model, rubric or schema.
+    # Call save() to persist new entries to disk.
+    def __init__(self, index_path=SEMANTIC_CACHE_INDEX, responses_path=SEMANTIC_CACHE_RESPONSES, threshold=SEMANTIC_CACHE_THRESHOLD, cache_ttl=GRADE_CACHE_TTL):
+        self.index_path = index_path
+        self.responses_path = responses_path
+        self.threshold = threshold
+        self.cache_ttl = cache_ttl
+
+        if os.path.exists(index_path) and os.path.exists(responses_path):
+            self.index = faiss.read_index(index_path)
+            with open(responses_path, "rb") as f:
+                self.responses = pickle.load(f)
+        else:
+            self.index = faiss.IndexFlatIP(EMBEDDING_DIM)
+            self.responses = []
+
+    async def embed(self, texts):
+        # Returns (normalized vectors, tokens used) for a list of texts. On failure returns (None, 0)
+        # so callers skip the semantic lookup instead of failing the grading.
+        try:
+            encoding = _embedding_encoding()
+            response = await _call_openai(
+                client.embeddings,
+                model=EMBEDDING_MODEL,
+                input=[encoding.encode(text, disallowed_special=())[:EMBEDDING_MAX_TOKENS] for text in texts]
+            )
+        except Exception as e:
+            print(f"Error embedding {len(texts)} comment(s), skipping semantic cache: {e}")
+            return None, 0
+        vectors = np.array([item.embedding for item in response.data], dtype="float32")
+        faiss.normalize_L2(vectors)
+        return vectors, response.usage.total_tokens
+
+    def lookup(self, vector):
+        # Returns (grading, ts) of the newest usable entry above the similarity threshold, or None
+        if self.index.ntotal == 0:
+            return None
+        _, _, ids = self.index.range_search(vector.reshape(1, -1), self.threshold)
+        version = _grading_version()
+        now = time.time()
+        best = None
+        for i in ids:
+            entry = self.responses[i]
+            if not isinstance(entry, tuple):
+                continue  # Saved before entries carried a ts and version
+            response, ts, entry_version = entry
+            if entry_version != version or (self.cache_ttl is not None and now - ts >= self.cache_ttl):
+                continue
+            if best is None or ts > best[1]:
+                best = (response, ts)
+        return best
+
+    def add(self, vector, response, ts=None):
+        self.index.add(vector.reshape(1, -1))
+        self.responses.append((response, time.time() if ts is None else ts, _grading_version()))
+
+    def save(self):
+        if os.path.dirname(self.index_path):
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        faiss.write_index(self.index, self.index_path)
+        with open(self.responses_path, "wb") as f:
+            pickle.dump(self.responses, f)
+
+grade_cache = GradeCache()
+semantic_cache = SemanticCache()
+processed_store = ProcessedPdfStore()
+
+def cached_call(cache=grade_cache, semantic_cache=semantic_cache):
+    # Caches the (content, tokens) result of an async grading call.
+    # The exact hash cache is checked first, then the semantic cache.
+    # Cache hits return the stored content and only report tokens spent on embedding.
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(comment_id, comment_text):
+            cached = cache.get(comment_text)
+            if cached is not None:
+                return cached, 0
+
+            vectors, embedding_tokens = await semantic_cache.embed([comment_text])
+            similar = semantic_cache.lookup(vectors[0]) if vectors is not None else None
+            if similar is not None:
+                content, ts = similar
+                cache.put(comment_text, content, 0, ts=ts)
+                return content, embedding_tokens
+
+            content, tokens = await func(comment_id, comment_text)
+            if content is not None:
+                cache.put(comment_text, content, tokens)
+                if vectors is not None:
+                    semantic_cache.add(vectors[0], content)
+            return content, tokens + embedding_tokens
+
+        return wrapper
+    return decorator
+
+# Returns (graded feedback, tokens used) so callers can total usage without shared state.
+@cached_call()
+async def grade_comment(comment_id, comment_text):
+    # Send the prompt to OpenAI's API; the grading comes back as a GradedComment JSON object
+    completion = await _call_openai(
+    client.beta.chat.completions,
+    "parse",
+    model=GRADING_MODEL,
     store=True,
+    response_format=GradedComment,
     messages=[
-        {"role": "developer", "content": prompt},
-        {"role": "user", "content": f"Please grade this comment with id: {comment_id} and content: {comment_text}"}
+        {"role": "system", "content": RUBRIC_SYSTEM},
+        {"role": "user", "content": f"id:{comment_id}\n\n{comment_text}"}
     ]
     )
 
-    global total_tokens 
-    total_tokens += completion.usage.total_tokens
+    graded = completion.choices[0].message.parsed
+    graded_feedback = graded.model_dump_json() if graded else None
+    return graded_feedback, completion.usage.total_tokens
 
-    return completion.choices[0].message.content
+# Grades several (comment_id, comment_text) pairs in one request.
+# Returns (graded feedback in the same order as items, tokens used); feedback is None where the
+# model returned nothing.
+async def grade_comment_batch(items):
+    results = [grade_cache.get(comment_text) for _, comment_text in items]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results, 0
 
-# Processes a CSV of PDF links, grades them, and writes to a separate CSV.
-def grade_all_comments(input_csv, output_csv):
-    
-    # Read input CSV
+    # Reuse gradings of near-duplicate comments before sending anything to the model
+    vectors, embedding_tokens = await semantic_cache.embed([items[i][1] for i in pending])
+    vector_by_item = dict(zip(pending, vectors)) if vectors is not None else {}
+    for i in vector_by_item:
+        similar = semantic_cache.lookup(vector_by_item[i])
+        if similar is not None:
+            results[i], ts = similar
+            grade_cache.put(items[i][1], results[i], 0, ts=ts)
+    pending = [i for i in pending if results[i] is None]
+    if not pending:
+        return results, embedding_tokens
+
+    # Number comments within the request; the returned "id" maps each grading back to its item
+    user_content = "\n\n".join(
+        f"Comment {n} (id={items[i][0]}):\n{items[i][1]}" for n, i in enumerate(pending, start=1)
+    )
+
+    completion = await _call_openai(
+    client.beta.chat.completions,
+    "parse",
+    model=GRADING_MODEL,
+    store=True,
+    response_format=GradedCommentBatch,
+    messages=[
+        {"role": "system", "content": RUBRIC_SYSTEM},
+        {"role": "system", "content": BATCH_INSTRUCTIONS},
+        {"role": "user", "content": user_content}
+    ]
+    )
+
+    tokens = completion.usage.total_tokens
+
+    batch = completion.choices[0].message.parsed
+    for grading in (batch.gradings if batch else []):
+        if 1 <= grading.id <= len(pending):
+            i = pending[grading.id - 1]
+            results[i] = grading.model_dump_json(exclude={"id"})
+            grade_cache.put(items[i][1], results[i], tokens // len(pending))
+            if i in vector_by_item:
+                semantic_cache.add(vector_by_item[i], results[i])
+
+    return results, tokens + embedding_tokens
+
+# Processes a CSV of PDF links, grades them concurrently, and writes to a separate CSV.
+# URLs recorded in processed_store are skipped unless skip_processed is False.
+# max_concurrent_requests limits grading calls; max_concurrent_downloads limits PDF downloads separately.
+# Like PDFTextExtractor.process_csv, it can also be called from a running event loop (e.g. a Jupyter cell).
+def grade_all_comments(input_csv, output_csv, max_concurrent_requests=MAX_CONCURRENT_REQUESTS, max_requests_per_min=MAX_REQUESTS_PER_MIN, batch_size=GRADING_BATCH_SIZE, skip_processed=True, max_concurrent_downloads=MAX_CONCURRENT_DOWNLOADS):
+    run_sync(_grade_all_comments(input_csv, output_csv, max_concurrent_requests, max_requests_per_min, batch_size, skip_processed, max_concurrent_downloads))
+
+# Reads the input CSV and returns every (commentId, PDF URL) pair to grade, or None if columns are missing.
+def _load_grading_jobs(input_csv):
     df = pd.read_csv(input_csv)
-    extractor = PDFTextExtractor(csv_file=input_csv, download_pdfs=False)
 
     if "commentId" not in df.columns or "attachmentLinks" not in df.columns:
         print("Required columns 'commentId' or 'attachmentLinks' not found in CSV.")
+        return None
+
+    # One row per attachment link. astype("string") keeps .str usable when read_csv gives an
+    # all-empty column a float dtype.
+    urls = df.assign(u=df["attachmentLinks"].astype("string").str.split("|")).explode("u")
+    urls["u"] = urls["u"].str.strip()
+    urls = urls[urls["u"].str.endswith(".pdf", na=False)]
+    return list(urls[["commentId", "u"]].itertuples(index=False, name=None))
+
+async def _grade_all_comments(input_csv, output_csv, max_concurrent_requests, max_requests_per_min, batch_size, skip_processed, max_concurrent_downloads):
+    
+    jobs = _load_grading_jobs(input_csv)
+    if jobs is None:
+        return
+    extractor = PDFTextExtractor(csv_file=input_csv, download_pdfs=False)
+
+    # Each URL is fetched and graded once, however many comments attach it
+    comment_ids_by_url = {}
+    for comment_id, pdf_url in jobs:
+        comment_ids_by_url.setdefault(pdf_url, []).append(comment_id)
+
+    # Downloads and grading calls are limited separately so grading can start while PDFs are still
+    # being fetched, rather than queueing behind every download
+    download_sem = asyncio.Semaphore(max_concurrent_downloads)
+    grading_sem = asyncio.Semaphore(max_concurrent_requests)
+    rate_limiter = RequestRateLimiter(max_requests_per_min)
+    # Per-call usage is summed here; tasks share one event loop thread, so no lock is needed
+    token_usage = Counter()
+    # Futures resolving to the grading (or None) of PDF content currently being extracted or graded
+    in_flight = {}
+
+    async with create_pdf_session() as session:
+        # Write graded feedback to output CSV as each batch finishes
+        with open(output_csv, "w", newline="", encoding="utf-8") as csvfile:
+            csv_writer = csv.writer(csvfile)
+            csv_writer.writerow(["commentId", "graded_feedback"])  # CSV headers
+
+            def _write_grading(comment_ids, pdf_url, content_sha256, graded_feedback):
+                for comment_id in comment_ids:
+                    csv_writer.writerow([comment_id, graded_feedback])
+                processed_store.mark_processed(pdf_url, content_sha256, comment_ids[0], graded_feedback)
+                print(f"Graded feedback for commentId(s) {comment_ids} written to output CSV.")
+
+            # URLs graded in earlier runs aren't fetched again; their stored gradings are carried over
+            if skip_processed:
+                skipped = 0
+                for pdf_url in list(comment_ids_by_url):
+                    if not processed_store.is_processed(pdf_url):
+                        continue
+                    comment_ids = comment_ids_by_url.pop(pdf_url)
+                    stored_grading = processed_store.get_url_grading(pdf_url)
+                    if stored_grading is not None:
+                        for comment_id in comment_ids:
+                            csv_writer.writerow([comment_id, stored_grading])
+                    skipped += 1
+                if skipped:
+                    print(f"Skipped {skipped} already processed PDF URL(s); reused their stored gradings.")
+
+            # Returns (comment_ids, pdf_url, content hash, extracted text) when the PDF needs grading,
+            # or None when it was handled here (failed fetch, no text, or identical content already graded)
+            async def _extract(comment_ids, pdf_url):
+                async with download_sem:
+                    print(f"Processing PDF from {pdf_url}...")
+
+                    # Download over the shared session
+                    pdf_data = await fetch_pdf(session, pdf_url)
+                    if pdf_data is None:
+                        return None
+
+                    content_sha256 = hashlib.sha256(pdf_data).hexdigest()
+                    existing_grading = processed_store.get_grading(content_sha256)
+                    pending_grading = in_flight.get(content_sha256)
+                    if existing_grading is None and pending_grading is None:
+                        # First copy of this content: claim it before any await so duplicates wait on it
+                        in_flight[content_sha256] = asyncio.get_running_loop().create_future()
+                        try:
+                            # Parsing runs in the extraction process pool
+                            pdf_text = await extract_text_in_pool(pdf_data, backend=extractor.extractor_backend)
+                        except Exception as e:
+                            print(f"Error extracting text from {pdf_url}: {e}")
+                            pdf_text = None
+
+                if existing_grading is None and pending_grading is not None:
+                    # Identical content is being graded right now: reuse its result (outside the semaphore)
+                    existing_grading = await pending_grading
+
+                if existing_grading is not None:
+                    _write_grading(comment_ids, pdf_url, content_sha256, existing_grading)
+                    print(f"Reused grading of identical PDF for commentId(s) {comment_ids}.")
+                    return None
+                if pending_grading is not None:
+                    return None
+
+                if not pdf_text:
+                    print(f"No text extracted for commentId(s) {comment_ids} from {pdf_url}")
+                    in_flight.pop(content_sha256).set_result(None)
+                    processed_store.mark_processed(pdf_url, content_sha256, comment_ids[0])
+                    return None
+                return comment_ids, pdf_url, content_sha256, pdf_text
+
+            async def _grade(batch):
+                gradings = [None] * len(batch)
+                async with grading_sem:
+                    await rate_limiter.wait()
+                    items = [(comment_ids[0], pdf_text) for comment_ids, _, _, pdf_text in batch]
+                    try:
+                        if len(items) == 1:
+                            graded_feedback, tokens = await grade_comment(*items[0])
+                            gradings = [graded_feedback]
+                        else:
+                            gradings, tokens = await grade_comment_batch(items)
+                        token_usage["total_tokens"] += tokens
+                    except Exception as e:
+                        print(f"Error grading commentIds {[comment_id for comment_id, _ in items]}: {e}")
+
+                for (comment_ids, pdf_url, content_sha256, _), graded_feedback in zip(batch, gradings):
+                    in_flight.pop(content_sha256).set_result(graded_feedback)
+                    if graded_feedback:
+                        _write_grading(comment_ids, pdf_url, content_sha256, graded_feedback)
+                    else:
+                        print(f"No grading returned for commentId(s) {comment_ids}")
+
+            extract_tasks = [
+                asyncio.create_task(_extract(comment_ids, pdf_url)) for pdf_url, comment_ids in comment_ids_by_url.items()
+            ]
+            grade_tasks = []
+
+            # Pack extracted comments into batches, flushing on count or size
+            batch, batch_chars = [], 0
+            for next_done in asyncio.as_completed(extract_tasks):
+                extracted = await next_done
+                if extracted is None:
+                    continue
+                pdf_text = extracted[3]
+
+                if batch and batch_chars + len(pdf_text) > GRADING_BATCH_MAX_CHARS:
+                    grade_tasks.append(asyncio.create_task(_grade(batch)))
+                    batch, batch_chars = [], 0
+
+                batch.append(extracted)
+                batch_chars += len(pdf_text)
+
+                if len(batch) >= batch_size:
+                    grade_tasks.append(asyncio.create_task(_grade(batch)))
+                    batch, batch_chars = [], 0
+
+            if batch:
+                grade_tasks.append(asyncio.create_task(_grade(batch)))
+
+            await asyncio.gather(*grade_tasks)
+
+    semantic_cache.save()
+    print(f"All graded feedback saved to {output_csv}")
+    print(f"Total tokens used: {token_usage['total_tokens']}")
+
+
+# Offline alternative to grade_all_comments: submits every grading through the OpenAI Batch API
+# (half the cost, no RPM contention, results within BATCH_COMPLETION_WINDOW) and waits for the results.
+def grade_all_comments_batch_api(input_csv, output_csv, batch_input_jsonl=BATCH_INPUT_JSONL, max_concurrent_downloads=MAX_CONCURRENT_DOWNLOADS):
+    run_sync(_grade_all_comments_batch_api(input_csv, output_csv, batch_input_jsonl, max_concurrent_downloads))
+
+async def _grade_all_comments_batch_api(input_csv, output_csv, batch_input_jsonl, max_concurrent_downloads):
+    jobs = _load_grading_jobs(input_csv)
+    if jobs is None:
         return
+    extractor = PDFTextExtractor(csv_file=input_csv, download_pdfs=False)
+    sem = asyncio.Semaphore(max_concurrent_downloads)
+    token_usage = Counter()
+
+    async def _extract(comment_id, pdf_url):
+        async with sem:
+            print(f"Processing PDF from {pdf_url}...")
+            pdf_text = await extractor.extract_text_from_pdf_url_async(session, pdf_url)
+
+        if not pdf_text:
+            print(f"No text extracted for commentId {comment_id} from {pdf_url}")
+        return comment_id, pdf_text
+
+    async with create_pdf_session() as session:
+        extracted = await asyncio.gather(*(_extract(comment_id, pdf_url) for comment_id, pdf_url in jobs))
 
-    # Process each PDF and write graded feedback to output CSV
     with open(output_csv, "w", newline="", encoding="utf-8") as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(["commentId", "graded_feedback"])  # CSV headers
 
-        for index, row in df.iterrows():
-            comment_id = row["commentId"]
-            pdf_links = row["attachmentLinks"]
+        # Cached gradings are written straight away; the rest go into the batch file.
+        # custom_id must be unique, and one comment can have several PDFs, so it includes the job index.
+        pending = {}
+        with open(batch_input_jsonl, "w", encoding="utf-8") as jsonlfile:
+            for n, (comment_id, pdf_text) in enumerate(extracted):
+                if not pdf_text:
+                    continue
+                cached = grade_cache.get(pdf_text)
+                if cached is not None:
+                    csv_writer.writerow([comment_id, cached])
+                    continue
 
-            if pd.notna(pdf_links):
-                pdf_urls = [url.strip() for url in pdf_links.split("|") if url.strip().endswith(".pdf")]
+                custom_id = f"{comment_id}#{n}"
+                pending[custom_id] = (comment_id, pdf_text)
+                jsonlfile.write(json.dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": GRADING_MODEL,
+                        "response_format": GRADED_COMMENT_RESPONSE_FORMAT,
+                        "messages": [
+                            {"role": "system", "content": RUBRIC_SYSTEM},
+                            {"role": "user", "content": f"id:{comment_id}\n\n{pdf_text}"}
+                        ]
+                    }
+                }) + "\n")
 
-                for pdf_url in pdf_urls:
-                    print(f"Processing PDF from {pdf_url}...")
+        if not pending:
+            print(f"All gradings were cached. Saved to {output_csv}")
+            return
 
-                    # Extract text from the PDF
-                    pdf_text = extractor.extract_text_from_pdf_url(pdf_url)
+        # Uploaded as bytes rather than an open file, so a retried upload resends the whole file
+        with open(batch_input_jsonl, "rb") as jsonlfile:
+            batch_input = jsonlfile.read()
+        batch_file = await _call_openai(client.files, file=(os.path.basename(batch_input_jsonl), batch_input), purpose="batch")
+        batch = await _call_openai(
+            client.batches,
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=BATCH_COMPLETION_WINDOW
+        )
+        print(f"Submitted batch {batch.id} with {len(pending)} comments.")
 
-                    if pdf_text:
-                        # Grade the comment using existing function
-                        graded_feedback = grade_comment(comment_id, pdf_text)
-                        csv_writer.writerow([comment_id, graded_feedback])
-                        print(f"Graded feedback for commentId {comment_id} written to output CSV.")
-                    else:
-                        print(f"No text extracted for commentId {comment_id} from {pdf_url}")
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+            batch = await _call_openai(client.batches, "retrieve", batch_id=batch.id)
+            print(f"Batch {batch.id} status: {batch.status} ({batch.request_counts.completed}/{batch.request_counts.total} done)")
+
+        # Each result is handled on its own so one refusal or malformed line doesn't lose the rest
+        if batch.output_file_id:
+            output = await _call_openai(client.files, "content", file_id=batch.output_file_id)
+            for line in output.text.splitlines():
+                try:
+                    result = json.loads(line)
+                    comment_id, pdf_text = pending.pop(result["custom_id"])
+                except (KeyError, TypeError, ValueError) as e:
+                    print(f"Skipping unreadable batch result line: {e}")
+                    continue
+
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    print(f"Batch request failed for commentId {comment_id}: {result.get('error') or response.get('body')}")
+                    continue
+
+                try:
+                    body = response["body"]
+                    message = body["choices"][0]["message"]
+                    if message.get("refusal"):
+                        raise ValueError(f"refused: {message['refusal']}")
+                    graded_feedback = GradedComment.model_validate_json(message["content"] or "").model_dump_json()
+                    tokens = body["usage"]["total_tokens"]
+                except (KeyError, IndexError, TypeError, ValueError) as e:
+                    print(f"Invalid grading for commentId {comment_id}: {e}")
+                    continue
+                token_usage["total_tokens"] += tokens
+
+                grade_cache.put(pdf_text, graded_feedback, tokens)
+                csv_writer.writerow([comment_id, graded_feedback])
+
+        # Requests that failed outright are only listed in the error file
+        if batch.error_file_id:
+            errors = await _call_openai(client.files, "content", file_id=batch.error_file_id)
+            for line in errors.text.splitlines():
+                try:
+                    result = json.loads(line)
+                    comment_id, _ = pending.pop(result["custom_id"])
+                except (KeyError, TypeError, ValueError) as e:
+                    print(f"Skipping unreadable batch error line: {e}")
+                    continue
+                response = result.get("response") or {}
+                print(f"Batch request failed for commentId {comment_id}: {result.get('error') or response.get('body')}")
+
+        if pending:
+            print(f"Batch {batch.id} finished with status '{batch.status}' and no result for {len(pending)} requests: "
+                  f"{sorted(pending)}")
 
     print(f"All graded feedback saved to {output_csv}")
-    print(f"Total tokens used: {total_tokens}")
+    print(f"Total tokens used: {token_usage['total_tokens']}")
 
 
-# Example usage
-grade_all_comments("data/EPA_Comments.csv", "data/graded_feedback.csv")
+# Example usage. Guarded because extraction runs in a process pool, whose workers re-import
+# __main__ under the spawn/forkserver start methods.
+if __name__ == "__main__":
+    grade_all_comments("data/EPA_Comments.csv", "data/graded_feedback.csv")
 
 
 # For debugging
@@ -114,5 +774,5 @@ grade_all_comments("data/EPA_Comments.csv", "data/graded_feedback.csv")
 # comment_id = "EPA-R03-RCRA-2008-0256"
 # comment_text = "I don't support this regulation because I don't like the environment."
 
-# graded_feedback = grade_comment(comment_id, comment_text)
+# graded_feedback, tokens = asyncio.run(grade_comment(comment_id, comment_text))
 # print(graded_feedback)
@@ -8,6 +8,7 @@ Finally, all temporary databases are merged into a single, combined SQLite datab
 """
 import nest_asyncio
 import asyncio
+import math
 import os
 import sqlite3
 import re
@@ -43,17 +44,32 @@ TABLES_TO_MERGE = [
 # Max number of concurrent tasks making network requests. 
 # Actual concurrency will also be limited by the number of available API keys.
 MAX_CONCURRENT_WORKERS = 200
-# Number of dockets a single worker task will process. Adjust for balance.
-DOCKETS_PER_TASK_CHUNK = 1 
+# Max number of dockets a single worker task will process. Larger chunks amortize worker setup
+# (logger, CommentsDownloader, temp DB) and leave fewer temp DBs to merge; chunks are made smaller
+# when needed so every available worker still gets work.
+DOCKETS_PER_TASK_CHUNK = 16
 TEMP_DB_DIR = "data/temp_dbs" # Directory to store temporary databases
+# Number of temp DBs attached and merged per transaction. SQLite allows 10 attached DBs by default.
+MERGE_ATTACH_GROUP_SIZE = 8
 
 # --- Helper function to merge SQLite databases ---
+# Used to rewrite temp DB schemas as "CREATE TABLE IF NOT EXISTS" for the final database
+_CREATE_RE = re.compile(r"CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?([`\"]?\w+[`\"]?)", re.IGNORECASE)
+_IFNOT_RE = re.compile(r"IF\s+NOT\s+EXISTS", re.IGNORECASE)
+_CREATE_PREFIX_RE = re.compile(r"CREATE\s+TABLE\s+", re.IGNORECASE)
+
 def merge_databases(temp_db_files, final_db_path, tables_to_merge):
     print(f"\nStarting merge of {len(temp_db_files)} temporary databases into {final_db_path}...")
     os.makedirs(os.path.dirname(final_db_path), exist_ok=True)
 
-    final_conn = sqlite3.connect(final_db_path)
+    # Autocommit mode: transactions are opened explicitly around each bulk insert below
+    final_conn = sqlite3.connect(final_db_path, isolation_level=None)
     final_cursor = final_conn.cursor()
+    # The combined DB holds earlier runs' data and the temp DBs are deleted after merging, so it must
+    # survive a crash: WAL with synchronous=NORMAL stays consistent and only syncs at checkpoints
+    final_cursor.executescript(
+        "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; PRAGMA cache_size=-200000;"
+    )
 
     first_valid_temp_db = next((f for f in temp_db_files if f and os.path.exists(f) and os.path.getsize(f) > 0), None)
 
@@ -62,31 +78,31 @@ def merge_databases(temp_db_files, final_db_path, tables_to_merge):
         final_conn.close()
         return
 
+    # Read every table schema from the schema source once
+    try:
+        temp_conn_s = sqlite3.connect(first_valid_temp_db)
+        temp_cursor_s = temp_conn_s.cursor()
+        temp_cursor_s.execute("SELECT name, sql FROM sqlite_master WHERE type='table'")
+        schemas = {name.lower(): sql for name, sql in temp_cursor_s.fetchall()}
+        temp_conn_s.close()
+    except sqlite3.Error as e:
+        print(f"Error reading schemas from {first_valid_temp_db}: {e}")
+        schemas = {}
+
     for table_name in tables_to_merge:
         created_table_in_final = False
         try:
-            temp_conn_s = sqlite3.connect(first_valid_temp_db)
-            temp_cursor_s = temp_conn_s.cursor()
-            temp_cursor_s.execute(
-                f"SELECT sql FROM sqlite_master WHERE type='table' AND lower(name)='{table_name.lower()}'"
-            )
-            schema_row = temp_cursor_s.fetchone()
-            if schema_row:
-                create_table_sql = schema_row[0]
-                pattern = re.compile(r"CREATE\s+TABLE\s+", re.IGNORECASE)
-                if not re.search(r"IF\s+NOT\s+EXISTS", create_table_sql, re.IGNORECASE):
-                    match = re.search(
-                        r"CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?([`\"]?\w+[`\"]?)",
-                        create_table_sql,
-                        re.IGNORECASE,
-                    )
+            create_table_sql = schemas.get(table_name.lower())
+            if create_table_sql:
+                if not _IFNOT_RE.search(create_table_sql):
+                    match = _CREATE_RE.search(create_table_sql)
                     if match:
                         tn = match.group(1)
                         create_table_sql = create_table_sql.replace(
                             f"CREATE TABLE {tn}", f"CREATE TABLE IF NOT EXISTS {tn}", 1
                         )
                     else:
-                        create_table_sql = pattern.sub(
+                        create_table_sql = _CREATE_PREFIX_RE.sub(
                             f"CREATE TABLE IF NOT EXISTS {table_name} ", create_table_sql, 1
                         )
                 final_cursor.execute(create_table_sql)
@@ -95,54 +111,88 @@ def merge_databases(temp_db_files, final_db_path, tables_to_merge):
                 print(f"Ensured table '{table_name}' exists in {final_db_path} using schema from {first_valid_temp_db}.")
             else:
                 print(f"Warning: Table '{table_name}' not found in schema source {first_valid_temp_db}.")
-            temp_conn_s.close()
         except sqlite3.Error as e:
             print(f"Error preparing table '{table_name}' in final DB using schema from {first_valid_temp_db}: {e}")
 
         if not created_table_in_final:
             print(f"CRITICAL: Table '{table_name}' could not be created in {final_db_path}.")
 
+    # Copy rows entirely inside SQLite: attach a group of temp DBs and INSERT ... SELECT from each,
+    # committing once per group. An attached DB can't be detached while the transaction that read
+    # it is open, so groups are bounded by SQLite's attached-database limit.
+    rows_merged_per_table = {table_name: 0 for table_name in tables_to_merge}
+    # Tables missing from the final DB are skipped, so they can't roll back the tables that do exist
+    final_cursor.execute("SELECT lower(name) FROM main.sqlite_master WHERE type='table'")
+    tables_in_final = {row[0] for row in final_cursor.fetchall()}
+
+    def merge_group(group_paths):
+        # Merges every table from group_paths in one transaction; returns new rows per table
+        aliases = []
+        group_rows = {table_name: 0 for table_name in tables_to_merge}
+        try:
+            for n, temp_db_path in enumerate(group_paths):
+                alias = f"src{n}"
+                final_cursor.execute(f"ATTACH DATABASE ? AS {alias}", (temp_db_path,))
+                aliases.append(alias)
+
+            final_cursor.execute("BEGIN IMMEDIATE")
+            for alias in aliases:
+                final_cursor.execute(f"SELECT lower(name) FROM {alias}.sqlite_master WHERE type='table'")
+                tables_in_temp = {row[0] for row in final_cursor.fetchall()}
+                for table_name in tables_to_merge:
+                    if table_name.lower() not in tables_in_temp or table_name.lower() not in tables_in_final:
+                        continue
+                    final_cursor.execute(f"INSERT OR IGNORE INTO main.{table_name} SELECT * FROM {alias}.{table_name}")
+                    group_rows[table_name] += max(final_cursor.rowcount, 0)
+            final_cursor.execute("COMMIT")
+            return group_rows
+        except sqlite3.Error:
+            if final_conn.in_transaction:
+                final_cursor.execute("ROLLBACK")
+            raise
+        finally:
+            for alias in aliases:
+                final_cursor.execute(f"DETACH DATABASE {alias}")
+
+    valid_temp_db_files = [
+        f for f in temp_db_files if f and os.path.exists(f) and os.path.getsize(f) > 0
+    ]
+    failed_temp_db_files = set()
+    for start in range(0, len(valid_temp_db_files), MERGE_ATTACH_GROUP_SIZE):
+        group_paths = valid_temp_db_files[start:start + MERGE_ATTACH_GROUP_SIZE]
+        try:
+            group_results = [merge_group(group_paths)]
+        except sqlite3.Error as e:
+            # Fall back to one temp DB per transaction so a single bad file doesn't drop the whole group
+            print(f"Error merging group of {len(group_paths)} temp DBs ({e}); retrying them one at a time.")
+            group_results = []
+            for temp_db_path in group_paths:
+                try:
+                    group_results.append(merge_group([temp_db_path]))
+                except sqlite3.Error as e:
+                    print(f"Error merging tables from {temp_db_path}: {e}.")
+                    failed_temp_db_files.add(temp_db_path)
+        for group_rows in group_results:
+            for table_name, count in group_rows.items():
+                rows_merged_per_table[table_name] += count
+
     total_rows_merged_all_tables = 0
     for table_name in tables_to_merge:
-        print(f"\n--- Merging data for table: {table_name} ---")
-        current_table_rows_merged = 0
-        for temp_db_path in temp_db_files:
-            if not temp_db_path or not os.path.exists(temp_db_path) or os.path.getsize(temp_db_path) == 0:
-                continue
-            try:
-                temp_conn = sqlite3.connect(temp_db_path)
-                temp_cursor = temp_conn.cursor()
-                temp_cursor.execute(
-                    f"SELECT name FROM sqlite_master WHERE type='table' AND lower(name)='{table_name.lower()}'"
-                )
-                if not temp_cursor.fetchone():
-                    temp_conn.close()
-                    continue
-                temp_cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-                row_count_in_temp = temp_cursor.fetchone()[0]
-                if row_count_in_temp == 0:
-                    temp_conn.close()
-                    continue
-                temp_cursor.execute(f"SELECT * FROM {table_name}")
-                for row in temp_cursor:
-                    try:
-                        placeholders = ', '.join(['?'] * len(row))
-                        final_cursor.execute(
-                            f"INSERT OR IGNORE INTO {table_name} VALUES ({placeholders})", row
-                        )
-                        if final_cursor.rowcount > 0:
-                            current_table_rows_merged += 1
-                    except sqlite3.Error:
-                        pass
-                final_conn.commit()
-                temp_conn.close()
-            except sqlite3.Error as e:
-                print(f"Error processing table '{table_name}' in {temp_db_path}: {e}.")
-        print(f"Total {current_table_rows_merged} new rows merged into table '{table_name}'.")
-        total_rows_merged_all_tables += current_table_rows_merged
+        print(f"Total {rows_merged_per_table[table_name]} new rows merged into table '{table_name}'.")
+        total_rows_merged_all_tables += rows_merged_per_table[table_name]
+
+    # Make the merged rows durable (synchronous=NORMAL commits aren't fsynced) before the temp DBs go away
+    busy, _, _ = final_cursor.execute("PRAGMA wal_checkpoint(FULL)").fetchone()
+    if busy:
+        print(f"Could not checkpoint {final_db_path}; keeping every temp DB.")
+        failed_temp_db_files.update(temp_db_files)
 
     print("\nCleaning up temporary database files...")
     for temp_db_path in temp_db_files:
+        if temp_db_path in failed_temp_db_files:
+            # Its rows aren't safely in the final DB, so keep it for a later merge
+            print(f"Keeping {temp_db_path} for a later merge.")
+            continue
         if temp_db_path and os.path.exists(temp_db_path):
             try:
                 os.remove(temp_db_path)
@@ -168,9 +218,8 @@ def merge_databases(temp_db_files, final_db_path, tables_to_merge):
 
 
 # --- Asynchronous Worker Function ---
-from asyncio import Lock
+# Incremented without a lock: every worker runs on the same event loop thread
 total_dockets_processed = 0
-counter_lock = Lock()
 
 async def process_docket_chunk(api_key_queue: asyncio.Queue, docket_chunk: list, worker_id: int, temp_dir: str):
     """
@@ -193,7 +242,6 @@ async def process_docket_chunk(api_key_queue: asyncio.Queue, docket_chunk: list,
         for docket_id in docket_chunk:
             logger.info(f"Processing docket: {docket_id}")
             try:
-                logger.info(f"PINEAPPLE: {docket_id}")
                 # Run the (assumed) blocking gather_comments_by_docket in a separate thread
                 await asyncio.to_thread(
                     downloader.gather_comments_by_docket,
@@ -202,17 +250,11 @@ async def process_docket_chunk(api_key_queue: asyncio.Queue, docket_chunk: list,
                     csv_filename=None # We want data in DB for merging
                 )
                 logger.info(f"Successfully processed docket: {docket_id}")
-                
-                async with counter_lock:
-                    print("BANANA")
-                    total_dockets_processed += 1
+                total_dockets_processed += 1
 
             except Exception as e:
                 logger.error(f"Error processing docket {docket_id}: {e}")
-                
-                async with counter_lock:
-                    print("BLUEBERRY")
-                    total_dockets_processed += 1
+                total_dockets_processed += 1
                 # Optional: Implement retry logic or add docket_id to a failed queue
         
         return temp_db_filename # Return path to the temporary DB for merging
@@ -250,15 +292,18 @@ async def run_concurrent_downloading_main(all_docket_ids: list, all_api_keys: li
     # Determine the number of concurrent worker tasks
     # Limited by MAX_CONCURRENT_WORKERS and the number of available API keys.
     num_active_workers = min(MAX_CONCURRENT_WORKERS, len(all_api_keys))
-    print(f"Configured to use up to {num_active_workers} concurrent workers.")
 
-    # Divide dockets into chunks for tasks
+    # Divide dockets into chunks for tasks, shrinking chunks if there would be fewer chunks than workers
     all_docket_ids = list(dict.fromkeys(all_docket_ids))
     num_total_dockets = len(all_docket_ids)
-    chunk_size = DOCKETS_PER_TASK_CHUNK
+    chunk_size = max(1, min(DOCKETS_PER_TASK_CHUNK, math.ceil(num_total_dockets / num_active_workers)))
     docket_chunks = [all_docket_ids[i:i + chunk_size] for i in range(0, num_total_dockets, chunk_size)]
     print(f"Divided {num_total_dockets} dockets into {len(docket_chunks)} chunks of up to {chunk_size} dockets each.")
 
+    # No more workers can be busy than there are chunks
+    num_active_workers = min(num_active_workers, len(docket_chunks))
+    print(f"Configured to use up to {num_active_workers} concurrent workers.")
+
     # Create and launch tasks
     # A semaphore can also be used here to explicitly limit active asyncio.to_thread calls if needed,
     # beyond the API key queue limit, but the queue itself acts as a resource limiter.
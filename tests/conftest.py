@@ -0,0 +1,13 @@
+import importlib.util
+import os
+import sys
+import sysconfig
+
+# The repo's secrets.py holds API keys and shadows the standard library module of the same name,
+# which numpy imports. Load the stdlib module before any test imports numpy, with a test key added
+# for autograder.
+_spec = importlib.util.spec_from_file_location("secrets", os.path.join(sysconfig.get_paths()["stdlib"], "secrets.py"))
+_secrets = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_secrets)
+_secrets.OPEN_API_KEY = "test-key"
+sys.modules["secrets"] = _secrets
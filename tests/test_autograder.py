@@ -0,0 +1,406 @@
+import asyncio
+import importlib
+
+import httpx
+import openai
+import pytest
+import tenacity
+
+
+@pytest.fixture(scope="module")
+def autograder():
+    return importlib.import_module("autograder")
+
+
+def chat_completion_json(content, total_tokens=7):
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-4o-mini",
+        "choices": [
+            {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}
+        ],
+        "usage": {"prompt_tokens": total_tokens - 2, "completion_tokens": 2, "total_tokens": total_tokens},
+    }
+
+
+def mock_client(handler):
+    return openai.AsyncOpenAI(
+        api_key="test-key",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+
+
+def test_call_openai_returns_parsed_completion(autograder):
+    client = mock_client(lambda request: httpx.Response(200, json=chat_completion_json("ok")))
+
+    completion = asyncio.run(autograder._call_openai(
+        client.chat.completions,
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": "hi"}],
+    ))
+
+    assert completion.choices[0].message.content == "ok"
+    assert completion.usage.total_tokens == 7
+
+
+def test_call_openai_parses_structured_grading(autograder):
+    grading = {
+        "authorship": "Citizen",
+        "professionalism": 4,
+        "use_of_evidence": "Yes",
+        "logical_argumentation": 3,
+        "emotional_tone": "Neutral",
+        "pro_environmental_regulation": 5,
+        "bias": "Primarily environmental concerns",
+        "other_feedback": "",
+    }
+    client = mock_client(lambda request: httpx.Response(200, json=chat_completion_json(autograder.json.dumps(grading))))
+
+    completion = asyncio.run(autograder._call_openai(
+        client.beta.chat.completions,
+        "parse",
+        model="gpt-4o-mini",
+        response_format=autograder.GradedComment,
+        messages=[{"role": "user", "content": "hi"}],
+    ))
+
+    assert completion.choices[0].message.parsed == autograder.GradedComment(**grading)
+
+
+def test_call_openai_retries_rate_limits_and_notes_headers(autograder, monkeypatch):
+    monkeypatch.setattr(autograder, "rate_limit_resume_at", 0.0)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"retry-after": "0"}, json={"error": {"message": "slow down"}})
+        return httpx.Response(
+            200,
+            headers={"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "30s"},
+            json=chat_completion_json("ok"),
+        )
+
+    client = mock_client(handler)
+    call_without_waits = autograder._call_openai.retry_with(wait=tenacity.wait_none())
+
+    completion = asyncio.run(call_without_waits(
+        client.chat.completions,
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": "hi"}],
+    ))
+
+    assert len(calls) == 2
+    assert completion.choices[0].message.content == "ok"
+    assert autograder.rate_limit_resume_at > autograder.time.monotonic() + 20
+
+
+class _NullSession:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+def test_grade_all_comments_dedupes_pdfs_and_keeps_prior_gradings(autograder, monkeypatch, tmp_path):
+    # a.pdf is attached to two comments and c.pdf has the same bytes as a.pdf
+    pdf_bytes = {"https://x/a.pdf": b"form letter", "https://x/b.pdf": b"unique", "https://x/c.pdf": b"form letter"}
+    fetched, graded = [], []
+
+    async def fake_fetch_pdf(session, url):
+        fetched.append(url)
+        await asyncio.sleep(0)
+        return pdf_bytes[url]
+
+    async def fake_extract_text_in_pool(pdf_data, is_file=False, backend=None):
+        await asyncio.sleep(0)
+        return pdf_data.decode()
+
+    async def fake_grade_comment(comment_id, comment_text):
+        graded.append(comment_text)
+        return f"graded {comment_text}", 1
+
+    monkeypatch.setattr(autograder, "create_pdf_session", _NullSession)
+    monkeypatch.setattr(autograder, "fetch_pdf", fake_fetch_pdf)
+    monkeypatch.setattr(autograder, "extract_text_in_pool", fake_extract_text_in_pool)
+    monkeypatch.setattr(autograder, "grade_comment", fake_grade_comment)
+    monkeypatch.setattr(autograder.semantic_cache, "save", lambda: None)
+    monkeypatch.setattr(autograder, "processed_store", autograder.ProcessedPdfStore(str(tmp_path / "processed_urls.sqlite")))
+    monkeypatch.chdir(tmp_path)
+
+    input_csv = tmp_path / "comments.csv"
+    input_csv.write_text(
+        "commentId,attachmentLinks\n"
+        "c1,https://x/a.pdf | https://x/b.pdf\n"
+        "c2,https://x/a.pdf\n"
+        "c3,https://x/c.pdf\n"
+        "c4,\n"
+    )
+    output_csv = tmp_path / "graded.csv"
+
+    def graded_rows():
+        return sorted(autograder.pd.read_csv(output_csv).itertuples(index=False, name=None))
+
+    expected = [
+        ("c1", "graded form letter"),
+        ("c1", "graded unique"),
+        ("c2", "graded form letter"),
+        ("c3", "graded form letter"),
+    ]
+
+    autograder.grade_all_comments(str(input_csv), str(output_csv), batch_size=1)
+    assert sorted(graded) == ["form letter", "unique"]
+    assert sorted(fetched) == ["https://x/a.pdf", "https://x/b.pdf", "https://x/c.pdf"]
+    assert graded_rows() == expected
+
+    # A second run fetches nothing new but still writes every earlier grading
+    fetched.clear()
+    autograder.grade_all_comments(str(input_csv), str(output_csv), batch_size=1)
+    assert fetched == []
+    assert sorted(graded) == ["form letter", "unique"]
+    assert graded_rows() == expected
+
+
+def test_grade_all_comments_runs_inside_a_running_loop(autograder, monkeypatch, tmp_path):
+    async def fake_fetch_pdf(session, url):
+        return url.encode()
+
+    async def fake_extract_text_in_pool(pdf_data, is_file=False, backend=None):
+        return pdf_data.decode()
+
+    async def fake_grade_comment(comment_id, comment_text):
+        return f"graded {comment_text}", 1
+
+    monkeypatch.setattr(autograder, "create_pdf_session", _NullSession)
+    monkeypatch.setattr(autograder, "fetch_pdf", fake_fetch_pdf)
+    monkeypatch.setattr(autograder, "extract_text_in_pool", fake_extract_text_in_pool)
+    monkeypatch.setattr(autograder, "grade_comment", fake_grade_comment)
+    monkeypatch.setattr(autograder.semantic_cache, "save", lambda: None)
+    monkeypatch.setattr(autograder, "processed_store", autograder.ProcessedPdfStore(str(tmp_path / "processed_urls.sqlite")))
+
+    input_csv = tmp_path / "comments.csv"
+    input_csv.write_text("commentId,attachmentLinks\nc1,https://x/a.pdf\n")
+
+    # The store's sqlite connection is opened on this thread; the calls below use it from run_sync's helper thread
+    assert not autograder.processed_store.is_processed("https://x/a.pdf")
+
+    async def notebook_cell():
+        for n in range(2):
+            autograder.grade_all_comments(str(input_csv), str(tmp_path / f"graded_{n}.csv"))
+
+    asyncio.run(notebook_cell())
+
+    for n in range(2):
+        rows = autograder.pd.read_csv(tmp_path / f"graded_{n}.csv")
+        assert list(rows.itertuples(index=False, name=None)) == [("c1", "graded https://x/a.pdf")]
+
+def test_grade_all_comments_starts_grading_before_downloads_finish(autograder, monkeypatch, tmp_path):
+    pdf_count = 40
+    events = []
+
+    async def fake_fetch_pdf(session, url):
+        await asyncio.sleep(0.001)
+        events.append("fetch")
+        return url.encode()
+
+    async def fake_extract_text_in_pool(pdf_data, is_file=False, backend=None):
+        return pdf_data.decode()
+
+    async def fake_grade_comment(comment_id, comment_text):
+        events.append("grade")
+        return f"graded {comment_text}", 1
+
+    monkeypatch.setattr(autograder, "create_pdf_session", _NullSession)
+    monkeypatch.setattr(autograder, "fetch_pdf", fake_fetch_pdf)
+    monkeypatch.setattr(autograder, "extract_text_in_pool", fake_extract_text_in_pool)
+    monkeypatch.setattr(autograder, "grade_comment", fake_grade_comment)
+    monkeypatch.setattr(autograder.semantic_cache, "save", lambda: None)
+    monkeypatch.setattr(autograder, "processed_store", autograder.ProcessedPdfStore(str(tmp_path / "processed_urls.sqlite")))
+
+    input_csv = tmp_path / "comments.csv"
+    input_csv.write_text("commentId,attachmentLinks\n" + "".join(f"c{n},https://x/{n}.pdf\n" for n in range(pdf_count)))
+    output_csv = tmp_path / "graded.csv"
+
+    autograder.grade_all_comments(str(input_csv), str(output_csv), max_concurrent_requests=2, max_requests_per_min=600000, batch_size=1, max_concurrent_downloads=2)
+
+    assert events.count("grade") == pdf_count
+    # Grading overlaps with downloading instead of waiting for every fetch to finish
+    assert events.index("grade") < len(events) - 1 - events[::-1].index("fetch")
+    assert len(autograder.pd.read_csv(output_csv)) == pdf_count
+
+def test_load_grading_jobs_handles_column_without_links(autograder, tmp_path):
+    input_csv = tmp_path / "comments.csv"
+    input_csv.write_text("commentId,attachmentLinks\nc1,\nc2,\n")
+
+    assert autograder._load_grading_jobs(str(input_csv)) == []
+
+
+class _FakeEncoding:
+    def encode(self, text, disallowed_special=()):
+        return list(range(len(text.split())))
+
+
+def test_grade_comment_still_grades_when_embedding_fails(autograder, monkeypatch):
+    grading = autograder.json.dumps({
+        "authorship": "Citizen",
+        "professionalism": 4,
+        "use_of_evidence": "No",
+        "logical_argumentation": 3,
+        "emotional_tone": "Neutral",
+        "pro_environmental_regulation": 2,
+        "bias": "Primarily economic concerns",
+        "other_feedback": "",
+    })
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(request.url.path)
+        if request.url.path.endswith("/embeddings"):
+            return httpx.Response(400, json={"error": {"message": "maximum context length is 8192 tokens"}})
+        return httpx.Response(200, json=chat_completion_json(grading, total_tokens=11))
+
+    stored = {}
+    monkeypatch.setattr(autograder, "client", mock_client(handler))
+    monkeypatch.setattr(autograder, "_embedding_encoding", lambda: _FakeEncoding())
+    monkeypatch.setattr(autograder.grade_cache, "get", lambda text: None)
+    monkeypatch.setattr(autograder.grade_cache, "put", lambda text, content, tokens: stored.update({text: content}))
+    monkeypatch.setattr(autograder.semantic_cache, "add", lambda vector, response: pytest.fail("nothing to add without a vector"))
+
+    feedback, tokens = asyncio.run(autograder.grade_comment("c1", "a very long comment"))
+
+    assert requests_seen == ["/v1/embeddings", "/v1/chat/completions"]
+    assert autograder.GradedComment.model_validate_json(feedback).professionalism == 4
+    assert tokens == 11
+    assert stored == {"a very long comment": feedback}
+
+
+def test_semantic_cache_respects_ttl_and_grading_version(autograder, monkeypatch, tmp_path):
+    cache = autograder.GradeCache(str(tmp_path / "grade_cache.sqlite"), cache_ttl=1)
+    semantic = autograder.SemanticCache(str(tmp_path / "semantic.index"), str(tmp_path / "semantic.pkl"), cache_ttl=1)
+    vector = autograder.np.zeros((1, autograder.EMBEDDING_DIM), dtype="float32")
+    vector[0, 0] = 1.0
+
+    async def fake_embed(texts):
+        return vector.repeat(len(texts), axis=0), 0
+
+    monkeypatch.setattr(semantic, "embed", fake_embed)
+    calls = []
+
+    @autograder.cached_call(cache, semantic)
+    async def grade(comment_id, comment_text):
+        calls.append(comment_text)
+        return f"grading {len(calls)}", 1
+
+    now = [1000.0]
+    monkeypatch.setattr(autograder.time, "time", lambda: now[0])
+
+    assert asyncio.run(grade("c1", "form letter")) == ("grading 1", 1)
+    assert asyncio.run(grade("c2", "form letter!")) == ("grading 1", 0)  # near-duplicate
+    assert len(calls) == 1
+
+    # Both the exact and the semantic entry have expired, so the comment is graded again
+    now[0] += 2
+    assert asyncio.run(grade("c2", "form letter!")) == ("grading 2", 1)
+    assert semantic.lookup(vector[0]) == ("grading 2", now[0])
+
+    # A different model, rubric or schema makes every semantic entry unusable
+    monkeypatch.setattr(autograder, "_grading_version", lambda: "another rubric")
+    assert semantic.lookup(vector[0]) is None
+
+def test_grade_all_comments_batch_api_keeps_good_results_and_reports_failures(autograder, monkeypatch, tmp_path, capsys):
+    grading = autograder.json.dumps({
+        "authorship": "NGO/Activist Group",
+        "professionalism": 5,
+        "use_of_evidence": "Yes",
+        "logical_argumentation": 4,
+        "emotional_tone": "Neutral",
+        "pro_environmental_regulation": 4,
+        "bias": "Balanced perspective",
+        "other_feedback": "",
+    })
+
+    def batch_line(custom_id, message):
+        return autograder.json.dumps({
+            "custom_id": custom_id,
+            "response": {"status_code": 200, "body": {
+                "choices": [{"index": 0, "message": message}],
+                "usage": {"total_tokens": 9},
+            }},
+        })
+
+    output_file = "\n".join([
+        batch_line("c1#0", {"role": "assistant", "content": grading}),
+        batch_line("c2#1", {"role": "assistant", "content": None, "refusal": "I can't grade this."}),
+        "not json",
+    ])
+    error_file = autograder.json.dumps({
+        "custom_id": "c3#2",
+        "response": {"status_code": 400, "body": {"error": {"message": "too long"}}},
+    })
+    uploads = []
+
+    def handler(request):
+        path = request.url.path
+        if path == "/v1/files":
+            uploads.append(request.read())
+            if len(uploads) == 1:
+                return httpx.Response(500, json={"error": {"message": "try again"}})
+            return httpx.Response(200, json={
+                "id": "file-in", "object": "file", "bytes": 1, "created_at": 0,
+                "filename": "batch.jsonl", "purpose": "batch", "status": "processed",
+            })
+        if path == "/v1/batches":
+            return httpx.Response(200, json={
+                "id": "batch-1", "object": "batch", "endpoint": "/v1/chat/completions",
+                "input_file_id": "file-in", "completion_window": "24h", "status": "completed",
+                "created_at": 0, "output_file_id": "file-out", "error_file_id": "file-err",
+                "request_counts": {"completed": 1, "failed": 1, "total": 4},
+            })
+        if path == "/v1/files/file-out/content":
+            return httpx.Response(200, text=output_file)
+        if path == "/v1/files/file-err/content":
+            return httpx.Response(200, text=error_file)
+        return httpx.Response(404, json={"error": {"message": path}})
+
+    async def fake_extract_text_from_pdf_url_async(self, session, pdf_url):
+        return f"text of {pdf_url}"
+
+    stored = {}
+    monkeypatch.setattr(autograder, "_call_openai", autograder._call_openai.retry_with(wait=tenacity.wait_none()))
+    monkeypatch.setattr(autograder, "client", mock_client(handler))
+    monkeypatch.setattr(autograder, "create_pdf_session", _NullSession)
+    monkeypatch.setattr(autograder.PDFTextExtractor, "extract_text_from_pdf_url_async", fake_extract_text_from_pdf_url_async)
+    monkeypatch.setattr(autograder.grade_cache, "get", lambda text: None)
+    monkeypatch.setattr(autograder.grade_cache, "put", lambda text, content, tokens: stored.update({text: content}))
+    monkeypatch.chdir(tmp_path)
+
+    input_csv = tmp_path / "comments.csv"
+    input_csv.write_text(
+        "commentId,attachmentLinks\n"
+        "c1,https://x/a.pdf\n"
+        "c2,https://x/b.pdf\n"
+        "c3,https://x/c.pdf\n"
+        "c4,https://x/d.pdf\n"
+    )
+    output_csv = tmp_path / "graded.csv"
+
+    autograder.grade_all_comments_batch_api(str(input_csv), str(output_csv), str(tmp_path / "batch.jsonl"))
+
+    rows = autograder.pd.read_csv(output_csv)
+    assert list(rows["commentId"]) == ["c1"]
+    assert autograder.GradedComment.model_validate_json(rows["graded_feedback"][0]).professionalism == 5
+    assert list(stored) == ["text of https://x/a.pdf"]
+    # The upload failed once and was retried with the full file
+    assert len(uploads) == 2
+    batch_input = (tmp_path / "batch.jsonl").read_bytes()
+    assert all(batch_input in upload for upload in uploads)
+    assert b'"custom_id": "c4#3"' in batch_input
+
+    out = capsys.readouterr().out
+    assert "Invalid grading for commentId c2" in out
+    assert "Batch request failed for commentId c3" in out
+    assert "['c4#3']" in out
@@ -0,0 +1,75 @@
+import importlib
+import os
+import sqlite3
+
+import nest_asyncio
+import pytest
+
+
+@pytest.fixture(scope="module")
+def concurrent_downloader():
+    # Importing the module calls nest_asyncio.apply(), which would patch asyncio for every other test
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(nest_asyncio, "apply", lambda: None)
+        return importlib.import_module("concurrent_downloader")
+
+
+def make_temp_db(path, ids, extra_column=False, other_table=False):
+    conn = sqlite3.connect(path)
+    if extra_column:
+        conn.execute("CREATE TABLE comments_detail (id TEXT PRIMARY KEY, body TEXT, extra TEXT)")
+        conn.executemany("INSERT INTO comments_detail VALUES (?, 'body', 'x')", [(str(i),) for i in ids])
+    else:
+        conn.execute("CREATE TABLE comments_detail (id TEXT PRIMARY KEY, body TEXT)")
+        conn.executemany("INSERT INTO comments_detail VALUES (?, 'body')", [(str(i),) for i in ids])
+    if other_table:
+        conn.execute("CREATE TABLE other (x INT)")
+        conn.execute("INSERT INTO other VALUES (1)")
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def final_tables_and_rows(final_db):
+    conn = sqlite3.connect(final_db)
+    tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    rows = conn.execute("SELECT COUNT(*) FROM comments_detail").fetchone()[0]
+    conn.close()
+    return tables, rows
+
+
+def test_merge_databases_merges_more_temp_dbs_than_can_be_attached(concurrent_downloader, tmp_path):
+    # 12 temp DBs is more than one attach group and more than SQLite's default limit of 10 attached DBs
+    temp_dbs = [make_temp_db(tmp_path / f"temp_{n}.db", range(n * 5, n * 5 + 10)) for n in range(12)]
+    final_db = tmp_path / "out" / "final.db"
+
+    concurrent_downloader.merge_databases(temp_dbs, str(final_db), ["comments_detail"])
+
+    assert final_tables_and_rows(final_db) == ({"comments_detail"}, 65)  # ids 0..64, overlaps ignored
+    assert not any(os.path.exists(path) for path in temp_dbs)
+
+
+def test_merge_databases_keeps_temp_db_with_mismatched_columns(concurrent_downloader, tmp_path):
+    temp_dbs = [make_temp_db(tmp_path / f"temp_{n}.db", range(n * 10, n * 10 + 10)) for n in range(3)]
+    bad_db = make_temp_db(tmp_path / "temp_bad.db", range(100, 110), extra_column=True)
+    # The bad DB shares an attach group with a good one, whose rows must survive the group's rollback
+    temp_dbs.insert(1, bad_db)
+    final_db = tmp_path / "out" / "final.db"
+
+    concurrent_downloader.merge_databases(temp_dbs, str(final_db), ["comments_detail"])
+
+    assert final_tables_and_rows(final_db) == ({"comments_detail"}, 30)
+    assert [path for path in temp_dbs if os.path.exists(path)] == [bad_db]
+
+
+def test_merge_databases_skips_tables_missing_from_final_db(concurrent_downloader, tmp_path):
+    # The first temp DB is the schema source and has no "other" table, so it is never created
+    temp_dbs = [
+        make_temp_db(tmp_path / f"temp_{n}.db", range(n * 10, n * 10 + 10), other_table=n > 0) for n in range(3)
+    ]
+    final_db = tmp_path / "out" / "final.db"
+
+    concurrent_downloader.merge_databases(temp_dbs, str(final_db), ["comments_detail", "other"])
+
+    assert final_tables_and_rows(final_db) == ({"comments_detail"}, 30)
+    assert not any(os.path.exists(path) for path in temp_dbs)
@@ -0,0 +1,82 @@
+import pymupdf
+import pytest
+
+import text_extractor
+
+ORIGINAL_ITER_TEXT = text_extractor.iter_text
+
+
+def make_pdf(page_texts):
+    doc = pymupdf.open()
+    for text in page_texts:
+        page = doc.new_page()
+        page.insert_text((72, 72), text)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+@pytest.mark.parametrize("backend", text_extractor.EXTRACTOR_BACKENDS)
+def test_extract_uses_newlines_with_every_backend(backend):
+    pdf = make_pdf(["Hello page 0\nsecond line", "Hello page 1"])
+
+    text = text_extractor._extract(pdf, backend=backend)
+
+    assert "\r" not in text
+    assert [line for line in text.split("\n") if line] == ["Hello page 0", "second line", "Hello page 1"]
+
+
+@pytest.mark.parametrize("backend", text_extractor.EXTRACTOR_BACKENDS)
+def test_extract_to_file_matches_extract_across_slots(backend, monkeypatch, tmp_path):
+    monkeypatch.setattr(text_extractor, "PAGE_SLOT_SIZE", 2)
+    monkeypatch.setattr(text_extractor, "iter_text", lambda doc, page_text: ORIGINAL_ITER_TEXT(doc, slot=2, page_text=page_text))
+    pdf = make_pdf([f"page {n}" for n in range(5)])
+    text_path = tmp_path / "text.txt"
+
+    assert text_extractor._extract_to_file(pdf, str(text_path), backend=backend) == str(text_path)
+    assert text_path.read_text(encoding="utf-8") == text_extractor._extract(pdf, backend=backend)
+
+
+class _NullSession:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+def test_process_csv_streams_text_into_outputs(monkeypatch, tmp_path):
+    pdfs = {
+        "https://x/a.pdf": make_pdf(['He said "no", twice', "page two"]),
+        "https://x/b.pdf": make_pdf(["plain"]),
+    }
+
+    async def fake_fetch_pdf(session, url):
+        return pdfs.get(url)
+
+    monkeypatch.setattr(text_extractor, "create_pdf_session", _NullSession)
+    monkeypatch.setattr(text_extractor, "fetch_pdf", fake_fetch_pdf)
+    input_csv = tmp_path / "comments.csv"
+    input_csv.write_text(
+        "commentId,docketId,attachmentLinks\n"
+        "c1,d1,https://x/a.pdf | https://x/missing.pdf\n"
+        "c2,d1,https://x/b.pdf\n"
+    )
+
+    extractor = text_extractor.PDFTextExtractor(
+        str(input_csv), download_pdfs=False, download_dir=str(tmp_path / "pdfs"), output_dir=str(tmp_path / "out")
+    )
+    extractor.process_csv()
+
+    rows = text_extractor.pd.read_csv(extractor.output_csv, keep_default_na=False)
+    expected_texts = [text_extractor._extract(pdfs["https://x/a.pdf"]), "", text_extractor._extract(pdfs["https://x/b.pdf"])]
+    assert list(rows["commentId"]) == ["c1", "c1", "c2"]
+    assert list(rows["pdf_text"]) == expected_texts
+    assert 'He said "no", twice' in expected_texts[0]
+
+    txt = open(extractor.output_txt, encoding="utf-8").read()
+    assert txt == (
+        f"\n--- COMMENT ID: c1 AND DOCKET ID: d1 ---\n{expected_texts[0]}\n"
+        "\n--- COMMENT ID: c1 AND DOCKET ID: d1 ---\nNone\n"
+        f"\n--- COMMENT ID: c2 AND DOCKET ID: d1 ---\n{expected_texts[2]}\n"
+    )
@@ -3,13 +3,174 @@
 import pandas as pd
 import requests
 import pymupdf  
+import pypdfium2 as pdfium
 import os
-from io import BytesIO
+from io import BytesIO, StringIO
 import csv
+import shutil
+import tempfile
+import asyncio
+import aiohttp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Connection pool limits shared by all concurrent PDF downloads.
+MAX_CONNECTIONS = 64
+MAX_CONNECTIONS_PER_HOST = 8
+# Max number of PDFs downloaded and parsed at once.
+MAX_CONCURRENT_DOWNLOADS = 32
+
+def create_pdf_session():
+    # One session per run so TLS connections are kept alive and reused across PDFs
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_HOST)
+    return aiohttp.ClientSession(connector=connector, headers={"User-Agent": "Mozilla/5.0"})
+
+async def fetch_pdf(session, url):
+    # Downloads a PDF over the shared session and returns its bytes, or None on failure
+    try:
+        async with session.get(url) as response:
+            if response.status == 200:
+                return await response.read()
+            print(f"Failed to fetch {url} - HTTP {response.status}")
+            return None
+    except Exception as e:
+        print(f"Error fetching {url}: {e}")
+        return None
+
+# Worker processes used for CPU-bound text extraction.
+MAX_EXTRACTION_WORKERS = os.cpu_count()
+
+_process_pool = None
+
+def get_process_pool():
+    # Created once on first use and shared by every extraction in the process
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=MAX_EXTRACTION_WORKERS)
+    return _process_pool
+
+# Number of pages extracted together before being written out, to bound memory on large PDFs.
+PAGE_SLOT_SIZE = 200
+
+# Text extraction libraries PDFTextExtractor can use. pypdfium2 is usually the faster of the two.
+EXTRACTOR_BACKENDS = ("pypdfium2", "pymupdf")
+DEFAULT_EXTRACTOR_BACKEND = "pypdfium2"
+
+def _pymupdf_page_text(doc, i):
+    return doc[i].get_text("text")
+
+def _pypdfium2_page_text(pdf, i):
+    page = pdf[i]
+    textpage = page.get_textpage()
+    try:
+        # pdfium ends lines with CRLF; normalize to match pymupdf so outputs and cache keys don't depend on the backend
+        return textpage.get_text_range().replace("\r\n", "\n")
+    finally:
+        textpage.close()
+        page.close()
+
+def iter_text(doc, slot=PAGE_SLOT_SIZE, page_text=_pymupdf_page_text):
+    # Yields (first page index, text) for each run of `slot` pages
+    page_count = len(doc)
+    for start in range(0, page_count, slot):
+        yield start, "\n".join(page_text(doc, i) for i in range(start, min(start + slot, page_count)))
+
+def _open_doc(pdf_source, is_file, backend):
+    # Returns (document, page text function) for the chosen backend
+    if backend == "pypdfium2":
+        return pdfium.PdfDocument(pdf_source), _pypdfium2_page_text  # Accepts a file path, bytes or a file-like object
+    if is_file:
+        return pymupdf.open(pdf_source), _pymupdf_page_text  # Open saved PDF file
+    return pymupdf.open(stream=pdf_source, filetype="pdf"), _pymupdf_page_text  # Open PDF from memory
+
+def _iter_stripped_text(pdf_source, is_file, backend):
+    # Yields the document text in slot-sized pieces, equal once joined to text.strip() of the whole
+    # text ("No text found" if there is none). Whitespace between pieces is held back until more text
+    # follows, so only one slot is in memory at a time.
+    doc, page_text = _open_doc(pdf_source, is_file, backend)
+    try:
+        page_count = len(doc)
+        held_whitespace, wrote_text, found_text = "", False, False
+        for start, slot_text in iter_text(doc, page_text=page_text):
+            if start:
+                slot_text = "\n" + slot_text
+            found_text = found_text or bool(slot_text)
+            if not wrote_text:
+                slot_text = slot_text.lstrip()
+            body = slot_text.rstrip()
+            if body:
+                yield held_whitespace + body
+                held_whitespace, wrote_text = slot_text[len(body):], True
+            elif wrote_text:
+                held_whitespace += slot_text
+            if page_count > PAGE_SLOT_SIZE:
+                print(f"Extracted pages {start + 1}-{min(start + PAGE_SLOT_SIZE, page_count)} of {page_count}")
+        if not found_text:
+            yield "No text found"
+    finally:
+        doc.close()
+
+def _extract(pdf_source, is_file=False, backend=DEFAULT_EXTRACTOR_BACKEND):
+    # Module-level (picklable) so it can run in the process pool. Returns the whole text, so use
+    # _extract_to_file when the text only needs to be written out.
+    try:
+        return "".join(_iter_stripped_text(pdf_source, is_file, backend))
+    except Exception as e:
+        print(f"Error extracting text: {e}")
+        return None
+
+def _extract_to_file(pdf_source, text_path, is_file=False, backend=DEFAULT_EXTRACTOR_BACKEND):
+    # Like _extract, but writes the text to text_path slot by slot, so memory stays bounded by
+    # PAGE_SLOT_SIZE pages however large the PDF is. Returns text_path, or None on failure.
+    try:
+        with open(text_path, "w", encoding="utf-8") as text_file:
+            for piece in _iter_stripped_text(pdf_source, is_file, backend):
+                text_file.write(piece)
+        return text_path
+    except Exception as e:
+        print(f"Error extracting text: {e}")
+        return None
+
+async def extract_text_in_pool(pdf_source, is_file=False, backend=DEFAULT_EXTRACTOR_BACKEND):
+    # Runs _extract in the shared process pool without blocking the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), _extract, pdf_source, is_file, backend)
+
+async def extract_text_to_file_in_pool(pdf_source, text_path, is_file=False, backend=DEFAULT_EXTRACTOR_BACKEND):
+    # Runs _extract_to_file in the shared process pool without blocking the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), _extract_to_file, pdf_source, text_path, is_file, backend)
+
+# Characters copied at a time when streaming extracted text into the output files.
+TEXT_COPY_CHUNK_CHARS = 1 << 20
+
+def _write_text_row(csvfile, fields, text_path):
+    # Writes fields plus the text in text_path as a final, quoted CSV column, a chunk at a time so the
+    # whole text is never held in memory. Always quoting that column is valid CSV and reads back the
+    # same as csv.writer's minimal quoting.
+    prefix = StringIO()
+    csv.writer(prefix, lineterminator="").writerow(list(fields) + [""])
+    csvfile.write(prefix.getvalue() + '"')
+    with open(text_path, encoding="utf-8") as text_file:
+        for chunk in iter(lambda: text_file.read(TEXT_COPY_CHUNK_CHARS), ""):
+            csvfile.write(chunk.replace('"', '""'))
+    csvfile.write('"\r\n')
+
+def run_sync(coro):
+    # Runs a coroutine to completion from synchronous code. asyncio.run() fails inside an already
+    # running loop (e.g. a Jupyter cell), so in that case the coroutine gets its own loop in a helper thread.
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
 
 class PDFTextExtractor:
-    def __init__(self, csv_file, download_pdfs=True, download_dir="downloaded_pdfs", output_csv="extracted_texts.csv", output_txt="extracted_text.txt", output_dir=""):
+    def __init__(self, csv_file, download_pdfs=True, download_dir="downloaded_pdfs", output_csv="extracted_texts.csv", output_txt="extracted_text.txt", output_dir="", extractor_backend=DEFAULT_EXTRACTOR_BACKEND):
         self.csv_file = csv_file
+        if extractor_backend not in EXTRACTOR_BACKENDS:
+            raise ValueError(f"Unknown extractor_backend '{extractor_backend}'. Choose from {EXTRACTOR_BACKENDS}.")
+        self.extractor_backend = extractor_backend  # PDF library used for text extraction
         self.download_pdfs = download_pdfs  # Toggle to download PDFs or process in memory
         self.download_dir = download_dir
         os.makedirs(self.download_dir, exist_ok=True)
@@ -41,18 +202,8 @@ class PDFTextExtractor:
 
     def extract_text_from_pdf(self, pdf_source, is_file=False):
         # Extracts text from a PDF file or an in-memory stream
-        try:
-            if is_file:
-                doc = pymupdf.open(pdf_source)  # Open saved PDF file
-            else:
-                doc = pymupdf.open(stream=pdf_source, filetype="pdf")  # Open PDF from memory
+        return _extract(pdf_source, is_file, self.extractor_backend)
 
-            text = "\n".join([page.get_text("text") for page in doc])
-            return text.strip() if text else "No text found"
-        except Exception as e:
-            print(f"Error extracting text: {e}")
-            return None
-        
     def extract_text_from_pdf_url(self, pdf_url):
         # Downloads PDF from URL and extracts text
         try:
@@ -67,55 +218,96 @@ class PDFTextExtractor:
             print(f"Error fetching PDF: {e}")
             return None
 
-    def process_csv(self):
+    async def extract_text_from_pdf_url_async(self, session, pdf_url):
+        # Downloads PDF over a shared aiohttp session and extracts text in the process pool
+        pdf_data = await fetch_pdf(session, pdf_url)
+        if pdf_data is None:
+            return None
+        return await extract_text_in_pool(pdf_data, backend=self.extractor_backend)
+
+    async def _extract_row_text(self, session, comment_id, attachment_index, pdf_url, text_path):
+        # Fetches one attachment and extracts its text into text_path, saving the PDF to disk first if
+        # download_pdfs is set. Returns text_path, or None on failure.
+        print(f"Processing PDF from {pdf_url}...")
+
+        pdf_data = await fetch_pdf(session, pdf_url)
+        if pdf_data is None:
+            return None
+
+        if not self.download_pdfs:
+            # Process PDF directly in memory
+            return await extract_text_to_file_in_pool(pdf_data, text_path, backend=self.extractor_backend)
+
+        # Save PDF to disk and extract text from file
+        # One file per attachment, since a comment's attachments download concurrently
+        pdf_filename = os.path.join(self.download_dir, f"pdf_{comment_id}_{attachment_index}.pdf")
+        with open(pdf_filename, "wb") as file:
+            file.write(pdf_data)
+        print(f"PDF downloaded: {pdf_filename}")
+        return await extract_text_to_file_in_pool(pdf_filename, text_path, is_file=True, backend=self.extractor_backend)
+
+    def process_csv(self, max_concurrent_downloads=MAX_CONCURRENT_DOWNLOADS):
         # Reads the CSV file, processes PDFs, and saves extracted text
+        run_sync(self.process_csv_async(max_concurrent_downloads))
+
+    async def process_csv_async(self, max_concurrent_downloads=MAX_CONCURRENT_DOWNLOADS):
+        # Coroutine form of process_csv, for callers that already run an event loop
         df = pd.read_csv(self.csv_file)
 
         if "attachmentLinks" not in df.columns:
             print("'attachmentLinks' column not found in CSV.")
             return
 
-        # Open output files for writing
-        with open(self.output_csv, "w", newline="", encoding="utf-8") as csvfile, open(self.output_txt, "w", encoding="utf-8") as txtfile:
-            csv_writer = csv.writer(csvfile)
-            csv_writer.writerow(["commentId", "docketId", "pdf_text"])  # Write CSV headers
-
-            for index, row in df.iterrows():
-                comment_id = row["commentId"]
-                docket_id = row["docketId"]
-                pdf_urls = row["attachmentLinks"]
-
-                if pd.notna(pdf_urls):
-                    # Handle multiple URLs per row
-                    pdf_urls = pdf_urls.split("|")
-                    pdf_urls = [url.strip() for url in pdf_urls if url.strip().endswith(".pdf")]
-
-                    if not pdf_urls:
-                        print(f"No valid PDFs at index {index} with commentId {comment_id}")
-                        continue
-
-                    for pdf_url in pdf_urls:
-                        print(f"Processing PDF from {pdf_url}...")
-
-                        if self.download_pdfs:
-                            # Save PDF to disk and extract text from file
-                            pdf_filename = os.path.join(self.download_dir, f"pdf_{comment_id}.pdf")
-                            pdf_path = self.download_pdf(pdf_url, pdf_filename)
-                            if pdf_path:
-                                pdf_text = self.extract_text_from_pdf(pdf_path, is_file=True)
+        # Collect every (commentId, docketId, attachment index, PDF URL) to process
+        jobs = []
+        for index, row in df.iterrows():
+            comment_id = row["commentId"]
+            docket_id = row["docketId"]
+            pdf_urls = row["attachmentLinks"]
+
+            if pd.notna(pdf_urls):
+                # Handle multiple URLs per row
+                pdf_urls = pdf_urls.split("|")
+                pdf_urls = [url.strip() for url in pdf_urls if url.strip().endswith(".pdf")]
+
+                if not pdf_urls:
+                    print(f"No valid PDFs at index {index} with commentId {comment_id}")
+                    continue
+
+                jobs.extend((comment_id, docket_id, n, pdf_url) for n, pdf_url in enumerate(pdf_urls, start=1))
+
+        sem = asyncio.Semaphore(max_concurrent_downloads)
+
+        # Extracted text goes to one temporary file per job and is streamed into the outputs from
+        # there, so no PDF's full text is held in memory
+        with tempfile.TemporaryDirectory() as text_dir:
+            async with create_pdf_session() as session:
+
+                async def _one(n, comment_id, docket_id, attachment_index, pdf_url):
+                    async with sem:
+                        text_path = os.path.join(text_dir, f"{n}.txt")
+                        return comment_id, docket_id, await self._extract_row_text(session, comment_id, attachment_index, pdf_url, text_path)
+
+                tasks = [asyncio.create_task(_one(n, *job)) for n, job in enumerate(jobs)]
+
+                # Open output files for writing
+                with open(self.output_csv, "w", newline="", encoding="utf-8") as csvfile, open(self.output_txt, "w", encoding="utf-8") as txtfile:
+                    csv_writer = csv.writer(csvfile)
+                    csv_writer.writerow(["commentId", "docketId", "pdf_text"])  # Write CSV headers
+
+                    # Downloads run concurrently, but rows are written in input CSV order
+                    for task in tasks:
+                        comment_id, docket_id, text_path = await task
+                        txtfile.write(f"\n--- COMMENT ID: {comment_id} AND DOCKET ID: {docket_id} ---\n")
+                        if text_path is None:
+                            csv_writer.writerow([comment_id, docket_id, None])
+                            txtfile.write("None\n")
                         else:
-                            # Process PDF directly in memory
-                            response = requests.get(pdf_url, stream=True, headers={"User-Agent": "Mozilla/5.0"})
-                            if response.status_code == 200:
-                                pdf_data = BytesIO(response.content)
-                                pdf_text = self.extract_text_from_pdf(pdf_data, is_file=False)
-                            else:
-                                print(f"Failed to fetch {pdf_url} - HTTP {response.status_code}")
-                                pdf_text = None
-
-                        # Write extracted text to CSV and TXT
-                        csv_writer.writerow([comment_id, docket_id, pdf_text])
-                        txtfile.write(f"\n--- COMMENT ID: {comment_id} AND DOCKET ID: {docket_id} ---\n{pdf_text}\n")
+                            _write_text_row(csvfile, [comment_id, docket_id], text_path)
+                            with open(text_path, encoding="utf-8") as text_file:
+                                shutil.copyfileobj(text_file, txtfile, TEXT_COPY_CHUNK_CHARS)
+                            txtfile.write("\n")
+                            os.remove(text_path)
                         print(f"Extracted text for commentId {comment_id} written to CSV & TXT.")
 
         print(f"All extracted text saved to {self.output_csv} & {self.output_txt}")